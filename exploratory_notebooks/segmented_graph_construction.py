@@ -4,122 +4,225 @@ import sys
 import logging
 import multiprocessing as mp
 from functools import partial
-from collections import Counter
 import yaml
 import pickle
 import numpy as np
 import pandas as pd
+import numba
+from numba import njit, prange
 import trackml.dataset
 import time
 from torch_geometric.data import Data
 
-def calc_dphi(phi1, phi2):
-    """Computes phi2-phi1 given in range [-pi,pi]"""
-    dphi = phi2 - phi1
-    dphi[dphi > np.pi] -= 2*np.pi
-    dphi[dphi < -np.pi] += 2*np.pi
-    return dphi
-
 def calc_eta(r, z):
     """Computes pseudorapidity
        (https://en.wikipedia.org/wiki/Pseudorapidity)
+       via eta = -ln(tan(theta/2)) = arcsinh(z/r)
     """
-    theta = np.arctan2(r, z)
-    return -1. * np.log(np.tan(theta / 2.))
+    return np.arcsinh(z / r)
 
 
-def select_edges(hits1, hits2, layer1, layer2, 
-                 phi_slope_max, z0_max, module_map=None):
-
-    # start with all possible pairs of hits
-    keys = ['evtid', 'r', 'phi', 'z', 'module_id']
-    hit_pairs = hits1[keys].reset_index().merge(
-        hits2[keys].reset_index(), on='evtid', suffixes=('_1', '_2'))
-
-    # compute geometric features of the line through each hit pair
-    dphi = calc_dphi(hit_pairs.phi_1, hit_pairs.phi_2)
-    dz = hit_pairs.z_2 - hit_pairs.z_1
-    dr = hit_pairs.r_2 - hit_pairs.r_1
-    eta_1 = calc_eta(hit_pairs.r_1, hit_pairs.z_1)
-    eta_2 = calc_eta(hit_pairs.r_2, hit_pairs.z_2)
-    deta = eta_2 - eta_1
-    dR = np.sqrt(deta**2 + dphi**2)
+@njit(cache=True, fastmath=True)
+def edge_features(r1, phi1, z1, r2, phi2, z2, 
+                  phi_slope_max, z0_max, r_barrel):
+    """ Computes dr, dphi, dz of the line through a hit pair
+        and whether it passes the geometric cuts; r_barrel is
+        the radius of the barrel layer the line must not cross
+        (r_barrel=0 disables the intersecting line cut)
+    """
+    dr = r2 - r1
+    dz = z2 - z1
+    # dphi = phi2-phi1 wrapped to [-pi,pi]
+    dphi = phi2 - phi1
+    if dphi > np.pi:
+        dphi -= 2*np.pi
+    elif dphi < -np.pi:
+        dphi += 2*np.pi
     
     # phi_slope and z0 used to filter spurious edges
-    phi_slope = dphi / dr
-    z0 = hit_pairs.z_1 - hit_pairs.r_1 * dz / dr
+    if dr == 0:
+        return dr, dphi, dz, False
+    z0 = z1 - r1 * dz / dr
+    good = (abs(dphi / dr) < phi_slope_max) and (abs(z0) < z0_max)
     
     # apply the intersecting line cut 
-    intersected_layer = dr.abs() < -1 
-    # 0th barrel layer to left EC or right EC
-    if (layer1 == 0) and (layer2 == 11 or layer2 == 4): 
-        z_coord = 71.56298065185547 * dz/dr + z0
-        intersected_layer = np.logical_and(z_coord > -490.975, 
-                                           z_coord < 490.975)
-    # 1st barrel layer to the left EC or right EC
-    if (layer1 == 1) and (layer2 == 11 or layer2 == 4): 
-        z_coord = 115.37811279296875 * dz / dr + z0
-        intersected_layer = np.logical_and(z_coord > -490.975, 
-                                           z_coord < 490.975)
+    if good and (r_barrel > 0):
+        z_coord = r_barrel * dz / dr + z0
+        good = not ((z_coord > -490.975) and (z_coord < 490.975))
+    return dr, dphi, dz, good
+
+
+@njit(cache=True)
+def in_module_map(module_map, mid1, mid2):
+    """ Tests bit mid2 of row mid1 in a bit-packed module map """
+    return (module_map[mid1, mid2 >> 3] >> (mid2 & 7)) & 1
+
+
+@njit(cache=True)
+def phi_window(phi2, phi1, window):
+    """ Returns the index ranges [a0, b0) and [a1, b1) of the hits 
+        in phi2 (sorted) within window of phi1, wrapping around 
+        at +-pi; the second range is empty unless the window wraps
+    """
+    n2 = len(phi2)
+    if window >= np.pi:
+        return 0, n2, 0, 0
+    lo, hi = phi1 - window, phi1 + window
+    a0, b0 = np.searchsorted(phi2, lo), np.searchsorted(phi2, hi)
+    a1, b1 = 0, 0
+    if lo < -np.pi:
+        a1, b1 = np.searchsorted(phi2, lo + 2*np.pi), n2
+    elif hi > np.pi:
+        a1, b1 = 0, np.searchsorted(phi2, hi - 2*np.pi)
+    return a0, b0, a1, b1
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def filter_edges(r1, phi1, eta1, z1, mid1, r2, phi2, eta2, z2, mid2,
+                 phi_slope_max, z0_max, r_barrel, module_map):
+    """ Applies the edge selection to pairs of hits between two
+        layers in two passes, first counting the edges kept per
+        hit in layer 1, then filling them in the same order; 
+        hits in layer 2 must be sorted by phi so that each hit in
+        layer 1 only visits those inside the phi window allowed 
+        by the phi_slope cut, |dphi| < phi_slope_max * max|dr|;
+        module_map is bit-packed (see load_module_maps), an empty
+        module_map disables the data-driven cut
+    """
+    n1 = len(r1)
+    use_module_map = (module_map.size > 0)
+    r2_min, r2_max = r2.min(), r2.max()
+    
+    # phi window of each layer 1 hit (slightly widened, it 
+    # only needs to contain every edge passing the cuts)
+    windows = np.empty((n1, 4), dtype=np.int64)
+    for i in prange(n1):
+        dr_max = max(abs(r2_max - r1[i]), abs(r2_min - r1[i]))
+        window = phi_slope_max * dr_max * (1 + 1e-5) + 1e-7
+        windows[i, 0], windows[i, 1], windows[i, 2], windows[i, 3] = \
+            phi_window(phi2, phi1[i], window)
+    
+    # count the surviving edges of each layer 1 hit
+    counts = np.zeros(n1, dtype=np.int64)
+    for i in prange(n1):
+        n_first = windows[i, 1] - windows[i, 0]
+        n_second = windows[i, 3] - windows[i, 2]
+        for c in range(n_first + n_second):
+            if c < n_first:
+                j = windows[i, 0] + c
+            else:
+                j = windows[i, 2] + c - n_first
+            if use_module_map and not in_module_map(module_map, 
+                                                    mid1[i], mid2[j]):
+                continue
+            good = edge_features(r1[i], phi1[i], z1[i], 
+                                 r2[j], phi2[j], z2[j], 
+                                 phi_slope_max, z0_max, r_barrel)[3]
+            if good:
+                counts[i] += 1
+    
+    # each layer 1 hit writes its edges from its own offset
+    offsets = np.zeros(n1 + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    n_edges = offsets[n1]
+    index_1 = np.empty(n_edges, dtype=np.int64)
+    index_2 = np.empty(n_edges, dtype=np.int64)
+    dr = np.empty(n_edges, dtype=r1.dtype)
+    dphi = np.empty(n_edges, dtype=r1.dtype)
+    dz = np.empty(n_edges, dtype=r1.dtype)
+    dR = np.empty(n_edges, dtype=r1.dtype)
+    for i in prange(n1):
+        k = offsets[i]
+        n_first = windows[i, 1] - windows[i, 0]
+        n_second = windows[i, 3] - windows[i, 2]
+        for c in range(n_first + n_second):
+            if c < n_first:
+                j = windows[i, 0] + c
+            else:
+                j = windows[i, 2] + c - n_first
+            if use_module_map and not in_module_map(module_map, 
+                                                    mid1[i], mid2[j]):
+                continue
+            dr_ij, dphi_ij, dz_ij, good = edge_features(
+                r1[i], phi1[i], z1[i], r2[j], phi2[j], z2[j], 
+                phi_slope_max, z0_max, r_barrel)
+            if not good:
+                continue
+            deta = eta2[j] - eta1[i]
+            index_1[k], index_2[k] = i, j
+            dr[k], dphi[k], dz[k] = dr_ij, dphi_ij, dz_ij
+            dR[k] = np.sqrt(deta**2 + dphi_ij**2)
+            k += 1
+            
+    return index_1, index_2, dr, dphi, dz, dR
+
+
+# radii of the barrel layers that barrel-to-endcap edges must not 
+# cross, keyed by layer pair (no cut for the other layer pairs)
+intersected_layer_radii = {(0,4): 71.56298065185547,   # 0th barrel layer 
+                           (0,11): 71.56298065185547,  # to left/right EC
+                           (1,4): 115.37811279296875,  # 1st barrel layer 
+                           (1,11): 115.37811279296875} # to left/right EC
+
+def select_edges(hits1, hits2, layer1, layer2, 
+                 phi_slope_max, z0_max, module_map=None):
+    """ Forms pairs of hits between two layers and keeps those 
+        passing the geometric and data-driven cuts; for each hit 
+        in layer1, only the hits of layer2 within the phi window 
+        allowed by phi_slope_max are tested, found by a binary 
+        search on the phi-sorted layer2 hits
+        - [hits1] = dict of n_hits1 arrays (see construct_graph)
+        - [hits2] = dict of n_hits2 arrays, sorted by phi
+    """
+    # barrel radius for the intersecting line cut (0 disables it)
+    r_barrel = intersected_layer_radii.get((layer1, layer2), 0.)
         
-    # mask edges not in the module map
-    mid1 = hit_pairs.module_id_1.values
-    mid2 = hit_pairs.module_id_2.values
-    in_module_map = True
-    if module_map is not None:
-        in_module_map = module_map[mid1, mid2]
+    # an empty module map disables the module map cut
+    if module_map is None:
+        module_map = np.zeros((0, 0), dtype=np.uint8)
     
     # filter edges according to selection criteria
-    good_edge_mask = ((phi_slope.abs() < phi_slope_max) & # geometric
-                      (z0.abs() < z0_max) &               # geometric
-                      (intersected_layer == False) &      # geometric
-                      (in_module_map))                    # data-driven
+    i, j, dr, dphi, dz, dR = filter_edges(
+        hits1['r'], hits1['phi'], hits1['eta'], hits1['z'], hits1['module_id'],
+        hits2['r'], hits2['phi'], hits2['eta'], hits2['z'], hits2['module_id'],
+        phi_slope_max, z0_max, r_barrel,     # geometric
+        module_map)                          # data-driven
     
     # store edges (in COO format) and geometric edge features 
-    selected_edges = {'edges': hit_pairs[['index_1', 'index_2']][good_edge_mask],
-                      'dr': dr[good_edge_mask],    
-                      'dphi': dphi[good_edge_mask], 
-                      'dz': dz[good_edge_mask],
-                      'dR': dR[good_edge_mask]}
+    selected_edges = {'index_1': hits1['index'][i],
+                      'index_2': hits2['index'][j],
+                      'dr': dr, 'dphi': dphi, 
+                      'dz': dz, 'dR': dR}
     
     return selected_edges 
 
-def check_truth_labels(hits, edges, y, particle_ids):
+def check_truth_labels(hits, edge_index, y, particle_ids):
     """ Corrects for extra edges surviving the barrel intersection
         cut, i.e. for each particle counts the number of extra 
         "transition edges" crossing from a barrel layer to an 
         innermost endcap slayer; the sum is n_incorrect
-        - [edges] = n_edges x 2
+        - [edge_index] = 2 x n_edges (positional hit indices)
         - [y] = n_edges
         - [particle_ids] = n_edges
     """
-    # layer indices for barrel-to-endcap edges
-    barrel_to_endcaps = {(0,4), (1,4), (2,4),    # barrel to l-EC
-                         (0,11), (1,11), (2,11)} # barrel to r-EC
-    
-    # group hits by particle id, get layer indices
-    hits_by_particle = hits.groupby('particle_id')
-    layers_1 = hits.layer.loc[edges.index_1].values
-    layers_2 = hits.layer.loc[edges.index_2].values
-
-    # loop over particle_id, particle_hits, 
-    # count extra transition edges as n_incorrect
-    n_incorrect = 0
-    for p, particle_hits in hits_by_particle:
-        particle_hit_ids = particle_hits['hit_id'].values
-        
-        # grab true segment indices for particle p
-        relevant_indices = ((particle_ids==p) & (y==1))
-        
-        # get layers connected by particle's edges
-        particle_l1 = layers_1[relevant_indices]
-        particle_l2 = layers_2[relevant_indices]
-        layer_pairs = set(zip(particle_l1, particle_l2))
-        
-        # count the number of transition edges
-        transition_edges = layer_pairs.intersection(barrel_to_endcaps)
-        if (len(transition_edges) > 1):
-            n_incorrect += 1
+    # layer indices for barrel-to-endcap edges, encoded as l1*32 + l2
+    barrel_to_endcaps = np.array([0*32+4, 1*32+4, 2*32+4,     # barrel to l-EC
+                                  0*32+11, 1*32+11, 2*32+11]) # barrel to r-EC
+    
+    # encode the layers connected by each edge
+    layers = hits.layer.values
+    layers_1, layers_2 = layers[edge_index[0]], layers[edge_index[1]]
+    edge_codes = layers_1.astype(np.int64)*32 + layers_2
+    
+    # grab true segments crossing from the barrel to an endcap
+    transition = np.isin(edge_codes, barrel_to_endcaps) & (y==1)
+    
+    # count the distinct transition layer pairs per particle, 
+    # particles with more than one have extra transition edges
+    pid_idx, _ = pd.factorize(particle_ids[transition])
+    particle_pairs = np.unique(pid_idx*32*32 + edge_codes[transition])
+    transition_edges = np.bincount(particle_pairs // (32*32))
+    n_incorrect = int(np.sum(transition_edges > 1))
             
     if (n_incorrect > 0):
         logging.info(f'incorrectly-labeled edges: {n_incorrect}')
@@ -133,16 +236,28 @@ def construct_graph(hits, layer_pairs, phi_slope_max, z0_max,
         between them based on geometric and/or data-driven
         constraints. 
     """
+    # split hits by layer once, keeping only the raw arrays 
+    # needed to build edges (each layer enters several pairs)
+    # and the hits' positional indices, i.e. their node indices;
+    # sorting by phi lets select_edges scan phi windows
+    keys = ['r', 'phi', 'eta', 'z', 'module_id']
+    columns = {key: hits[key].values for key in keys}
+    layer_hits = {}
+    for layer, node_idx in hits.groupby('layer').indices.items():
+        node_idx = node_idx[np.argsort(columns['phi'][node_idx], kind='stable')]
+        layer_hits[layer] = {key: columns[key][node_idx] for key in keys}
+        layer_hits[layer]['index'] = node_idx
+    
     # loop over layer pairs, assign edges between their hits
-    groups = hits.groupby('layer')
-    edges, dr, dphi, dz, dR = [], [], [], [], []
+    index_1, index_2 = [], []
+    dr, dphi, dz, dR = [], [], [], []
     module_map = None
     for (layer1, layer2) in layer_pairs:
         if module_maps is not None: 
             module_map = module_maps[(layer1, layer2)]
         try:
-            hits1 = groups.get_group(layer1)
-            hits2 = groups.get_group(layer2)
+            hits1 = layer_hits[layer1]
+            hits2 = layer_hits[layer2]
         except KeyError as e: # skip if layer is empty
             continue
             
@@ -150,7 +265,8 @@ def construct_graph(hits, layer_pairs, phi_slope_max, z0_max,
         selected_edges = select_edges(hits1, hits2, layer1, layer2,
                                       phi_slope_max, z0_max,  # geometric 
                                       module_map=module_map)  # data-driven
-        edges.append(selected_edges['edges'])
+        index_1.append(selected_edges['index_1'])
+        index_2.append(selected_edges['index_2'])
         dr.append(selected_edges['dr'])
         dphi.append(selected_edges['dphi'])
         dz.append(selected_edges['dz'])
@@ -158,12 +274,12 @@ def construct_graph(hits, layer_pairs, phi_slope_max, z0_max,
     
     # if edges were reconstructed, concatenate edge 
     # attributes and indices across all layer pairs 
-    if len(edges) > 0:
-        edges = pd.concat(edges)
-        dr, dphi = pd.concat(dr), pd.concat(dphi)
-        dz, dR = pd.concat(dz), pd.concat(dR)
+    if len(index_1) > 0:
+        index_1, index_2 = np.concatenate(index_1), np.concatenate(index_2)
+        dr, dphi = np.concatenate(dr), np.concatenate(dphi)
+        dz, dR = np.concatenate(dz), np.concatenate(dR)
     else: # if no edges were reconstructed, return empty graph 
-        edges = np.array([])
+        index_1, index_2 = np.array([]), np.array([])
         dr, dphi = np.array([]), np.array([])
         dz, dR = np.array([]), np.array([])
         x = (hits[feature_names].values / feature_scale).astype(np.float32)
@@ -171,30 +287,22 @@ def construct_graph(hits, layer_pairs, phi_slope_max, z0_max,
                 'edge_attr': np.array([[],[],[],[]]), 
                 'y': [], 's': s, 'n_incorrect': 0}
     
-    # prepare the graph matrices
-    n_nodes = hits.shape[0]
-    n_edges = edges.shape[0]
-    
     # select and scale relevant features
     x = (hits[feature_names].values / feature_scale).astype(np.float32)
     edge_attr = np.stack((dr/feature_scale[0], 
                           dphi/feature_scale[1], 
                           dz/feature_scale[2], 
                           dR))
-    y = np.zeros(n_edges, dtype=np.float32)
-
-    # use a series to map hit label-index onto positional-index.
-    node_idx = pd.Series(np.arange(n_nodes), index=hits.index)
-    edge_start = node_idx.loc[edges.index_1].values
-    edge_end = node_idx.loc[edges.index_2].values
-    edge_index = np.stack((edge_start, edge_end))
+    
+    # edges already hold positional (node) indices
+    edge_index = np.stack((index_1, index_2))
 
     # fill the edge, particle labels
     # true edges have the same pid, ignore noise (pid=0)
-    pid1 = hits.particle_id.loc[edges.index_1].values
-    pid2 = hits.particle_id.loc[edges.index_2].values
-    y[:] = ((pid1 == pid2) & (pid1>0) & (pid2>0)) 
-    n_incorrect = check_truth_labels(hits, edges, y, pid1)
+    pid = hits.particle_id.values
+    pid1, pid2 = pid[index_1], pid[index_2]
+    y = ((pid1 == pid2) & (pid1>0) & (pid2>0)).astype(np.float32)
+    n_incorrect = check_truth_labels(hits, edge_index, y, pid1)
     
     return {'x': x, 'edge_index': edge_index, 'edge_attr': edge_attr, 
             'y': y, 's': s, 'n_incorrect': n_incorrect}
@@ -237,30 +345,47 @@ def select_hits(hits, truth, particles, pt_min=0, endcaps=False,
     
     # True particle selection.
     particles = particles[particles.pt > pt_min]
-    truth_noise = truth[['hit_id', 'particle_id']][truth.particle_id==0]
-    truth_noise['pt'] = 0
+    truth_noise = (truth[['hit_id', 'particle_id']][truth.particle_id==0]
+                   .assign(pt=0., eta_pt=0.))
     truth = (truth[['hit_id', 'particle_id']]
-             .merge(particles[['particle_id', 'pt', 'eta_pt']], on='particle_id'))
+             .merge(particles[['particle_id', 'pt', 'eta_pt']], 
+                    on='particle_id', how='inner', validate='m:1'))
 
     # optionally add noise 
     if (not remove_noise): 
-        truth = truth.append(truth_noise)
+        truth = pd.concat([truth, truth_noise], ignore_index=True)
 
     # calculate derived hits variables
     hits['r'] = np.sqrt(hits.x**2 + hits.y**2)
     hits['phi'] = np.arctan2(hits.y, hits.x)
     hits['eta'] = calc_eta(hits.r, hits.z)
     
+    # single precision suffices at tracker resolution and halves 
+    # the memory traffic of every pass over the hits and edges
+    coords = ['r', 'phi', 'eta', 'z']
+    hits[coords] = hits[coords].astype(np.float32)
+    hits['layer'] = hits.layer.astype(np.int8)
+    hits['module_id'] = hits.module_id.astype(np.int32)
+    
     # select the data columns we need
     hits = (hits[['hit_id', 'r', 'phi', 'eta', 'z', 'layer', 'module_id']]
-            .merge(truth[['hit_id', 'particle_id', 'pt', 'eta_pt']], on='hit_id'))
+            .merge(truth[['hit_id', 'particle_id', 'pt', 'eta_pt']], 
+                   on='hit_id', how='inner', validate='1:1'))
     
     # optionally remove duplicates
     if (remove_duplicates):
         noise_hits = hits[hits.particle_id==0]
         particle_hits = hits[hits.particle_id!=0]
-        particle_hits = particle_hits.loc[particle_hits.groupby(['particle_id', 'layer']).r.idxmin()]
-        hits = particle_hits.append(noise_hits)
+        # keep the innermost hit per (particle, layer), i.e. the 
+        # first one after sorting by particle, layer, and r
+        pid = particle_hits.particle_id.values
+        layer = particle_hits.layer.values
+        order = np.lexsort((particle_hits.r.values, layer, pid))
+        pid, layer = pid[order], layer[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (pid[1:] != pid[:-1]) | (layer[1:] != layer[:-1])
+        particle_hits = particle_hits.iloc[order[first]]
+        hits = pd.concat([particle_hits, noise_hits])
         
     # relabel particle IDs in [1:n_particles]
     particles = particles[particles.particle_id.isin(pd.unique(hits.particle_id))]
@@ -270,117 +395,157 @@ def select_hits(hits, truth, particles, pt_min=0, endcaps=False,
     hits = hits.assign(particle_id=hits['particle_id'].map(particle_id_map))
     return hits, particles
 
-def get_particle_properties(hits_by_particle, valid_connections, debug=False):
+def get_valid_pairs(layer_pairs, n_layers=18):
+    """ Dense (n_layers x n_layers) lookup table of the valid layer
+        pair connections, built once and shared by all truth passes
+    """
+    valid_pairs = np.zeros((n_layers, n_layers), dtype=bool)
+    for (layer1, layer2) in layer_pairs:
+        valid_pairs[layer1, layer2] = True
+    return valid_pairs
+
+
+def count_track_segs(group_idx, layers, valid_pairs, n_groups):
+    """ Counts the track segments produced by each group of hits 
+        (a particle, or a particle within a sector), i.e. the hit 
+        pairs between its consecutive hit layers whenever the 
+        layer pair is a valid connection (see get_valid_pairs)
+         - group_idx: group index in [0, n_groups) of each hit
+         - n_track_segs: number of track segments per group
+         - reconstructable: true if no consecutive layer pair is invalid
+    """
+    # store hit multiplicity per group and layer 
+    n_layers = valid_pairs.shape[0]
+    hits_per_layer = np.zeros((n_groups, n_layers), dtype=np.int64)
+    np.add.at(hits_per_layer, (group_idx, layers), 1)
+    
+    # consecutive layers hit by each group (row-major order) 
+    group_hit, layer_hit = np.nonzero(hits_per_layer)
+    same_group = (group_hit[1:] == group_hit[:-1])
+    group_pair = group_hit[1:][same_group]
+    layer1 = layer_hit[:-1][same_group]
+    layer2 = layer_hit[1:][same_group]
+    is_valid = valid_pairs[layer1, layer2]
+    
+    # total number of track segments produced by each group 
+    segs = (hits_per_layer[group_pair, layer1] * 
+            hits_per_layer[group_pair, layer2])
+    n_track_segs = np.bincount(group_pair, weights=segs*is_valid,
+                               minlength=n_groups).astype(np.int64)
+    
+    # single-hits aren't reconstructable, otherwise 
+    # all edges must be valid for a reconstructable particle
+    n_pairs = np.bincount(group_pair, minlength=n_groups)
+    n_invalid = np.bincount(group_pair, weights=~is_valid,
+                            minlength=n_groups)
+    reconstructable = (n_pairs > 0) & (n_invalid == 0)
+    
+    return n_track_segs, reconstructable
+
+
+def get_particle_properties(hits, valid_pairs, debug=False):
     """ Calculates the following truth quantities per particle:
          - n_track_segs: number of track segments generated
          - reconstructable: true if particle doesn't skip a layer
          - pt: particle transverse momentum [GeV]
          - eta: pseudorapidity w.r.t. transverse and longitudinal momentum
     """
-    # loop over particle_ids and corresponding particle hits
-    n_track_segs, reconstructable = {}, {}
-    pt, eta = {}, {}
-    for particle_id, particle_hits in hits_by_particle:
-        
-        # noise isn't reconstructable, store 0s
-        if (particle_id==0): 
-            reconstructable[particle_id] = 0
-            pt[particle_id] = 0
-            eta[particle_id] = 0
-            n_track_segs[particle_id] = 0
-            continue
-            
-        # store pt and eta 
-        pt[particle_id] = particle_hits.pt.values[0]
-        eta[particle_id] = particle_hits.eta_pt.values[0]
-        
-        # store hit multiplicity per layer 
-        layers_hit = particle_hits.layer.values
-        hits_per_layer = Counter(layers_hit) 
-        layers = np.unique(layers_hit)
-        
-        # single-hits aren't reconstructable
-        if (len(layers)==1): 
-            reconstructable[particle_id] = 0
-            n_track_segs[particle_id] = 0
-            continue
-        
-        # all edges must be valid for a reconstructable particle
-        layer_pairs = set(zip(layers[:-1], layers[1:]))
-        reconstructable[particle_id] = layer_pairs.issubset(valid_connections)
-        
-        # total number of track segments produced by particle 
-        good_layer_pairs = layer_pairs.intersection(valid_connections)
-        count = 0
-        for good_lp in good_layer_pairs:
-            count += hits_per_layer[good_lp[0]] * hits_per_layer[good_lp[1]]
-        n_track_segs[particle_id] = count
-        
-        if debug and (particle_id%100==0):
-            print('Test Hit Pattern:', layers_hit)
-            print(' - layer pairs:', layer_pairs)
-            print(' - reconstructable:', reconstructable[particle_id])
-            print(' - n_track_segs:', n_track_segs[particle_id])
-            print(' - pt', pt[particle_id])
-            print(' - eta', eta[particle_id])
+    pid_idx, particle_ids = pd.factorize(hits.particle_id.values, sort=True)
+    n_track_segs, reconstructable = count_track_segs(
+        pid_idx, hits.layer.values, valid_pairs, len(particle_ids))
+    
+    # noise isn't reconstructable and doesn't produce track segments
+    is_noise = (particle_ids == 0)
+    n_track_segs[is_noise] = 0
+    reconstructable[is_noise] = False
+    
+    # store pt and eta (shared by a particle's hits), 0s for noise
+    truth = hits.groupby('particle_id', sort=True).agg(
+        pt=('pt', 'first'), eta=('eta_pt', 'first'))
+    pt = np.where(is_noise, 0, truth.pt.values)
+    eta = np.where(is_noise, 0, truth.eta.values)
+    
+    if debug:
+        for i in np.flatnonzero((particle_ids%100==0) & ~is_noise):
+            print('Test Hit Pattern:', hits.layer.values[pid_idx==i])
+            print(' - reconstructable:', reconstructable[i])
+            print(' - n_track_segs:', n_track_segs[i])
+            print(' - pt', pt[i])
+            print(' - eta', eta[i])
         
-    return {'pt': pt, 'eta': eta, 'n_track_segs': n_track_segs, 
-            'reconstructable': reconstructable}
+    particle_ids = particle_ids.tolist()
+    return {'pt': dict(zip(particle_ids, pt.tolist())), 
+            'eta': dict(zip(particle_ids, eta.tolist())), 
+            'n_track_segs': dict(zip(particle_ids, n_track_segs.tolist())), 
+            'reconstructable': dict(zip(particle_ids, reconstructable.tolist()))}
 
 
-def get_n_track_segs(hits_by_particle, valid_connections):
-    """ Calculates the number of track segments present in 
-        a subset of hits generated by a particle
+def get_n_track_segs_per_sector(hits_sectors, valid_pairs):
+    """ Calculates the number of track segments each particle
+        produces within each sector, in a single pass over the 
+        hits of all sectors grouped by (sector, particle)
         (used for analyzing efficiency per sector)
     """
-    # loop over particle_ids and corresponding particle hits
-    n_track_segs = {}
-    for particle_id, particle_hits in hits_by_particle:
-        
-        # noise doesn't produce true edges
-        if (particle_id==0): 
-            n_track_segs[particle_id] = 0
-            continue
-            
-        # store hit multiplicity per layer 
-        layers_hit = particle_hits.layer.values
-        hits_per_layer = Counter(layers_hit) 
-        layers = np.unique(layers_hit)
-        
-        # single-hits don't produce truth edges
-        if (len(layers)==1): 
-            n_track_segs[particle_id] = 0
-            continue
-        
-        # all edges must be valid for a reconstructable particle
-        layer_pairs = set(zip(layers[:-1], layers[1:]))
-        
-        # total number of true edges produced by particle 
-        good_layer_pairs = layer_pairs.intersection(valid_connections)
-        count = 0
-        for good_lp in good_layer_pairs:
-            count += hits_per_layer[good_lp[0]] * hits_per_layer[good_lp[1]]
-        n_track_segs[particle_id] = count
-        
-    return n_track_segs
+    sectors = list(hits_sectors.keys())
+    sector_idx = np.concatenate([np.full(len(sector_hits), i) for i, sector_hits 
+                                 in enumerate(hits_sectors.values())])
+    particle_ids = np.concatenate([sector_hits.particle_id.values 
+                                   for sector_hits in hits_sectors.values()])
+    layers = np.concatenate([sector_hits.layer.values 
+                             for sector_hits in hits_sectors.values()])
+    
+    # one group per (sector, particle), sorted by sector then particle
+    pid_idx, pids = pd.factorize(particle_ids, sort=True)
+    group_idx, groups = pd.factorize(sector_idx*len(pids) + pid_idx, sort=True)
+    n_track_segs, _ = count_track_segs(group_idx, layers, valid_pairs, 
+                                       len(groups))
+    group_sector, group_pid = np.divmod(groups, len(pids))
+    group_pid = pids[group_pid]
+    
+    # noise doesn't produce true edges
+    n_track_segs[group_pid == 0] = 0
+    
+    # split the groups back into {s: {particle_id: n_track_segs}}
+    bounds = np.searchsorted(group_sector, np.arange(len(sectors) + 1))
+    n_track_segs_per_s = {}
+    for i, s in enumerate(sectors):
+        sector_groups = slice(bounds[i], bounds[i+1])
+        n_track_segs_per_s[s] = dict(zip(group_pid[sector_groups].tolist(),
+                                         n_track_segs[sector_groups].tolist()))
+    return n_track_segs_per_s
+
+
+def assign_sectors(values, edges):
+    """ Returns the index k of the open interval (edges[k], edges[k+1])
+        containing each value, or -1 if there is none
+    """
+    upper = np.searchsorted(edges, values, side='left')
+    upper_edge = edges[np.minimum(upper, len(edges) - 1)]
+    inside = (upper > 0) & (upper < len(edges)) & (values < upper_edge)
+    return np.where(inside, upper - 1, -1)
 
 
 def split_detector_sectors(hits, phi_edges, eta_edges, verbose=False):
     """Split hits according to provided phi and eta boundaries."""
     hits_sectors = {}
     sector_info = {}
+    # Bin all hits in phi and eta at once, using the hit eta
+    # already computed in select_hits
+    phi_sector = assign_sectors(hits.phi.values, phi_edges)
+    eta_sector = assign_sectors(hits.eta.values, eta_edges)
+    # Center hits on phi=0 within their phi sector
+    phi_centers = ((phi_edges[:-1] + phi_edges[1:]) / 2).astype(hits.phi.dtype)
+    centered_phi = hits.phi.values - phi_centers[phi_sector]
+    hits = hits.assign(phi=centered_phi, phi_sector=phi_sector)
+    # Positional indices of the hits in each (phi, eta) sector
+    sector_indices = hits.groupby([phi_sector, eta_sector]).indices
+    no_hits = np.array([], dtype=np.int64)
     for i in range(len(phi_edges) - 1):
         phi_min, phi_max = phi_edges[i], phi_edges[i+1]
-        # Select hits in this phi sector
-        phi_hits = hits[(hits.phi > phi_min) & (hits.phi < phi_max)]
-        # Center these hits on phi=0
-        centered_phi = phi_hits.phi - (phi_min + phi_max) / 2
-        phi_hits = phi_hits.assign(phi=centered_phi, phi_sector=i)
         for j in range(len(eta_edges) - 1):
             eta_min, eta_max = eta_edges[j], eta_edges[j+1]
-            # Select hits in this eta sector
-            eta = calc_eta(phi_hits.r, phi_hits.z)
-            sec_hits = phi_hits[(eta > eta_min) & (eta < eta_max)]
+            # Select hits in this sector
+            sec_hits = hits.iloc[sector_indices.get((i, j), no_hits)]
             
             # label hits by tuple s = (eta_sector, phi_sector)
             hits_sectors[(j,i)] = sec_hits.assign(eta_sector=j)
@@ -475,12 +640,31 @@ def graph_summary(evtid, sectors, particle_properties,
             'sector_stats': sector_stats}
 
 
-def process_event(prefix, output_dir, module_maps, pt_min, 
-                  n_eta_sectors, n_phi_sectors,
-                  eta_range, phi_range, phi_slope_max, z0_max,
-                  endcaps, remove_noise, remove_duplicates):
-    
-    # define valid layer pair connections
+# per-process state, filled once in each worker by init_worker
+worker_state = {'module_maps': None}
+
+def load_module_maps(module_map_path):
+    """ Loads the module maps, one boolean (module_id_1, module_id_2)
+        matrix per layer pair, bit-packed along module_id_2 (bit 
+        mid2 & 7 of byte mid2 >> 3) to cut their memory footprint 8x
+    """
+    module_maps = np.load(module_map_path, allow_pickle=True).item()
+    return {key: np.packbits(item.astype(bool), axis=1, bitorder='little')
+            for key, item in module_maps.items()}
+
+def init_worker(module_map_path=None, n_workers=1):
+    """ Pool initializer: loads the module maps once per worker 
+        instead of pickling them along with every task, and splits
+        the cores between the workers' numba thread pools
+    """
+    numba.set_num_threads(max(1, min(numba.config.NUMBA_NUM_THREADS,
+                                     (os.cpu_count() or 1) // n_workers)))
+    if module_map_path is not None:
+        worker_state['module_maps'] = load_module_maps(module_map_path)
+
+
+def get_layer_pairs(endcaps):
+    """ Returns the valid layer pair connections """
     layer_pairs = [(0,1), (1,2), (2,3)] # barrel-barrel
     if endcaps:
         layer_pairs.extend([(0,4), (1,4), (2,4),  # barrel-LEC
@@ -489,12 +673,58 @@ def process_event(prefix, output_dir, module_maps, pt_min,
                             (7,8), (8,9), (9,10), 
                             (11,12), (12,13), (13,14), # REC-REC
                             (14,15), (15,16), (16,17)])
+    return layer_pairs
+
+
+# trackml columns used downstream, per event part
+event_columns = {'hits': ['hit_id', 'x', 'y', 'z', 
+                          'volume_id', 'layer_id', 'module_id'],
+                 'particles': ['particle_id', 'px', 'py', 'pz'],
+                 'truth': ['hit_id', 'particle_id']}
+
+def load_event_cached(prefix, cache_dir, parts=['hits', 'particles', 'truth']):
+    """ Loads the requested parts of an event, keeping only the 
+        columns used downstream; the first load parses the CSVs
+        and stores each part as parquet in cache_dir, later loads
+        read the parquet files instead
+    """
+    base_prefix = os.path.basename(prefix)
+    paths = [os.path.join(cache_dir, f'{base_prefix}-{part}.parquet')
+             for part in parts]
+    if all(os.path.exists(path) for path in paths):
+        return [pd.read_parquet(path, columns=event_columns[part])
+                for path, part in zip(paths, parts)]
+    
+    # parse the CSVs, write to a temporary file and rename 
+    # so that an interrupted write never leaves a bad cache
+    os.makedirs(cache_dir, exist_ok=True)
+    tables = trackml.dataset.load_event(prefix, parts=parts)
+    tables = [table[event_columns[part]] for table, part in zip(tables, parts)]
+    for table, path in zip(tables, paths):
+        table.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    return tables
+
+
+def prepare_event(prefix, pt_min, endcaps, remove_noise, remove_duplicates,
+                  cache_dir=None):
+    """ Loads an event and runs the steps that don't depend on the
+        sectoring (hit selection and particle truth), so that they
+        can be reused for every sector configuration; if cache_dir 
+        is given the event is loaded through a parquet cache
+    """
+    # define valid layer pair connections
+    layer_pairs = get_layer_pairs(endcaps)
+    valid_pairs = get_valid_pairs(layer_pairs)
                                  
     # load the data
     evtid = int(prefix[-9:])
     logging.info('Event %i, loading data' % evtid)
-    hits, particles, truth = trackml.dataset.load_event(
-        prefix, parts=['hits', 'particles', 'truth'])
+    if cache_dir is not None:
+        hits, particles, truth = load_event_cached(prefix, cache_dir)
+    else:
+        hits, particles, truth = trackml.dataset.load_event(
+            prefix, parts=['hits', 'particles', 'truth'])
 
     # apply hit selection
     logging.info('Event %i, selecting hits' % evtid)
@@ -503,28 +733,38 @@ def process_event(prefix, output_dir, module_maps, pt_min,
     hits = hits.assign(evtid=evtid)
     
     # get truth information for each particle
-    hits_by_particle = hits.groupby('particle_id')
-    particle_properties = get_particle_properties(hits_by_particle,
-                                                  set(layer_pairs), debug=False)
+    particle_properties = get_particle_properties(hits, valid_pairs, 
+                                                  debug=False)
     hits = hits[['hit_id', 'r', 'phi', 'eta', 'z', 'evtid',
                  'layer', 'module_id', 'particle_id']]
     
+    return {'evtid': evtid, 'hits': hits, 'layer_pairs': layer_pairs,
+            'valid_pairs': valid_pairs,
+            'particle_properties': particle_properties}
+
+
+def process_event(event, output_dir, n_eta_sectors, n_phi_sectors,
+                  eta_range, phi_range, phi_slope_max, z0_max):
+    """ Splits a prepared event (see prepare_event) into sectors
+        and builds one graph per sector
+    """
+    evtid, hits = event['evtid'], event['hits']
+    layer_pairs, valid_pairs = event['layer_pairs'], event['valid_pairs']
+    particle_properties = dict(event['particle_properties'])
+    
     # divide detector into sectors
     phi_edges = np.linspace(*phi_range, num=n_phi_sectors+1)
     eta_edges = np.linspace(*eta_range, num=n_eta_sectors+1)
     hits_sectors, sector_info = split_detector_sectors(hits, phi_edges, eta_edges)
     
     # calculate particle truth in each sector
-    n_track_segs_per_s = {}
-    for s, hits_sector in hits_sectors.items():
-        hits_sector_by_particle = hits_sector.groupby('particle_id')
-        n_track_segs_s = get_n_track_segs(hits_sector_by_particle, set(layer_pairs))
-        n_track_segs_per_s[s] = n_track_segs_s
-    particle_properties['n_track_segs_per_s'] = n_track_segs_per_s
+    particle_properties['n_track_segs_per_s'] = get_n_track_segs_per_sector(
+        hits_sectors, valid_pairs)
     
     # graph features and scale
     feature_names = ['r', 'phi', 'z']
-    feature_scale = np.array([1000., np.pi / n_phi_sectors, 1000.])
+    feature_scale = np.array([1000., np.pi / n_phi_sectors, 1000.], 
+                             dtype=np.float32)
 
     # Construct the graph
     logging.info('Event %i, constructing graphs' % evtid)
@@ -532,7 +772,8 @@ def process_event(prefix, output_dir, module_maps, pt_min,
                                phi_slope_max=phi_slope_max, z0_max=z0_max,
                                s=s, feature_names=feature_names,
                                feature_scale=feature_scale,
-                               evtid=evtid, module_maps=module_maps)
+                               evtid=evtid, 
+                               module_maps=worker_state['module_maps'])
                for s, sector_hits in hits_sectors.items()]
 
     logging.info('Event %i, calculating graph summary' % evtid)
@@ -567,6 +808,7 @@ pt_map = {0: '0p0', 0.5: '0p5', 0.6: '0p6', 0.7: '0p7', 0.8: '0p8', 0.9: '0p9',
 
 input_dir = '/scratch/data/exatrkx/train_1'
 output_dir = 'gnns-for-tracking'
+cache_dir = os.path.join(output_dir, 'event_cache') # parquet copies of the CSVs
 module_map_dir = None
 n_files = 1770
 evtid_range = [1000,1020]
@@ -610,19 +852,30 @@ file_prefixes = [prefix for prefix in file_prefixes
 # Split the input files by number of tasks and select my chunk only
 file_prefixes = np.array_split(file_prefixes, n_tasks)[task]
 
-# Load module maps
-module_maps = None
+# Module maps are loaded by each worker (see init_worker)
+module_map_path = None
 if module_map_dir is not None:
-    module_maps = np.load(f"{module_map_dir}/module_map_2_{pt_str}GeV.npy", 
-                          allow_pickle=True).item()
-    module_maps = {key: item.astype(bool) for key, item in module_maps.items()}
+    module_map_path = f"{module_map_dir}/module_map_2_{pt_str}GeV.npy"
+
+# one worker pool, reused by the sector grid scan below; events
+# are independent, so take them in chunks as workers free up
+pool = mp.Pool(processes=n_workers, initializer=init_worker,
+               initargs=(module_map_path, n_workers))
+chunksize = max(1, len(file_prefixes) // (n_workers*4))
 
-with mp.Pool(processes=n_workers) as pool:
-    process_func = partial(process_event, output_dir=output_dir,
-                           phi_range=(-np.pi, np.pi), 
-                           module_maps=module_maps,
-                           **config)
-    output = pool.map(process_func, file_prefixes)
+# load and select hits once, they don't depend on the sectoring
+prepare_keys = ['pt_min', 'endcaps', 'remove_noise', 'remove_duplicates']
+prepare_func = partial(prepare_event, cache_dir=cache_dir,
+                       **{key: config[key] for key in prepare_keys})
+events = list(pool.imap_unordered(prepare_func, file_prefixes, 
+                                  chunksize=chunksize))
+
+process_func = partial(process_event, output_dir=output_dir,
+                       phi_range=(-np.pi, np.pi), 
+                       **{key: value for key, value in config.items()
+                          if key not in prepare_keys})
+output = list(pool.imap_unordered(process_func, events, 
+                                  chunksize=chunksize))
     
 # analyze output statistics
 logging.info('All done!')
@@ -672,6 +925,20 @@ for s in range(num_sectors):
                  f'...efficiency: {efficiency_s.mean():.5f}+/-{efficiency_s.std():.5f}')
     
 
+@njit(cache=True)
+def mean_std(a):
+    """ Returns the mean and (population) std of a in one pass """
+    n = a.shape[0]
+    # shift by the first value to limit cancellation in s2/n - m^2
+    shift = float(a[0])
+    s, s2 = 0., 0.
+    for k in range(n):
+        v = float(a[k]) - shift
+        s += v
+        s2 += v*v
+    m = s/n
+    return shift + m, np.sqrt(max(s2/n - m*m, 0.))
+
 n_eta_sectors = [1,2,4,8]
 n_phi_sectors = [1,2,4,8]
 shape = (len(n_eta_sectors), len(n_phi_sectors))
@@ -686,23 +953,20 @@ boundary_fractions_err = np.zeros(shape)
 for i, neta in enumerate(n_eta_sectors):
     for j, nphi in enumerate(n_phi_sectors):
         print(neta, nphi)
-        config = {'pt_min': 2, # GeV,
-          'phi_slope_max': 0.0006,
+        # reuse the prepared events (same pt_min, endcaps, 
+        # noise and duplicate removal), only the sectors change
+        config = {'phi_slope_max': 0.0006,
           'z0_max': 15000,
           'n_phi_sectors': nphi,
           'n_eta_sectors': neta,
           'eta_range': [-5, 5],
-          'endcaps': True,
-          'remove_noise': True, 
-          'remove_duplicates': True,
          }
         
-        with mp.Pool(processes=n_workers) as pool:
-            process_func = partial(process_event, output_dir=output_dir,
-                                   phi_range=(-np.pi, np.pi), 
-                                   module_maps=module_maps,
-                                   **config)
-            output = pool.map(process_func, file_prefixes)
+        process_func = partial(process_event, output_dir=output_dir,
+                               phi_range=(-np.pi, np.pi), 
+                               **config)
+        output = list(pool.imap_unordered(process_func, events, 
+                                          chunksize=chunksize))
         
         # analyze output statistics
         logging.info('All done!')
@@ -712,61 +976,88 @@ for i, neta in enumerate(n_eta_sectors):
         efficiency = np.array([graph_stats['efficiency'] for graph_stats in output])
         boundary_fraction = np.array([graph_stats['boundary_fraction'] for graph_stats in output])
     
-        n_edges[i,j] = edge_counts.mean()
-        n_edges_err[i,j] = edge_counts.std()
-        purities[i,j] = purity.mean()
-        purities_err[i,j] = purity.std()
-        efficiencies[i,j] = efficiency.mean()
-        efficiencies_err[i,j] = efficiency.std()
-        boundary_fractions[i,j] = boundary_fraction.mean()
-        boundary_fractions_err[i,j] = boundary_fraction.std()
+        n_edges[i,j], n_edges_err[i,j] = mean_std(edge_counts)
+        purities[i,j], purities_err[i,j] = mean_std(purity)
+        efficiencies[i,j], efficiencies_err[i,j] = mean_std(efficiency)
+        boundary_fractions[i,j], boundary_fractions_err[i,j] = mean_std(boundary_fraction)
+pool.close()
+pool.join()
 
 import numpy as np
+import matplotlib
+# the heatmaps are only written to file, no interactive backend needed
+matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 import matplotlib.colors as mcolors
 import mplhep as hep
 plt.style.use(hep.style.ROOT)
+# resolution for all heatmaps, set once on top of the ROOT style
+plt.rcParams.update({'figure.dpi': 300, 'savefig.dpi': 300})
 #plt.style.use('seaborn-paper')
 #plt.rc('mathtext',**{'default':'regular'})
+
+# tick positions at the cell centers, shared by all heatmaps
+eta_ticks = np.arange(1, len(n_eta_sectors)+1) - 0.5
+phi_ticks = np.arange(1, len(n_phi_sectors)+1) - 0.5
   
 def plot_hist2d(data, data_err, label, 
                 fmt='percent', cmap='Purples', v=[0.1, 0.2]):
-    fig, ax = plt.subplots(dpi=300)
-    heatmap = ax.pcolor(data, edgecolors='k', 
-                        cmap=cmap, vmin=v[0], vmax=v[1])
-    ax.set_xticks(np.arange(1,len(n_eta_sectors)+1) - 0.5)
+    fig, ax = plt.subplots()
+    # single QuadMesh without per-cell edge strokes; the cell 
+    # borders are drawn as one set of horizontal and vertical lines
+    heatmap = ax.pcolormesh(data, edgecolors='face', linewidth=0, 
+                            cmap=cmap, vmin=v[0], vmax=v[1])
+    n_rows, n_cols = data.shape
+    ax.hlines(np.arange(n_rows+1), 0, n_cols, colors='k', linewidth=0.25)
+    ax.vlines(np.arange(n_cols+1), 0, n_rows, colors='k', linewidth=0.25)
+    ax.set_xticks(eta_ticks)
     ax.set_xticklabels(n_eta_sectors)
-    ax.set_yticks(np.arange(1,len(n_phi_sectors)+1) - 0.5)
+    ax.set_yticks(phi_ticks)
     ax.set_yticklabels(n_phi_sectors)
     ax.set_xlabel('$\eta$ sectors')
     ax.set_ylabel('$\phi$ sectors')
-    labels = np.empty(data.shape, dtype="S16")
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            if (fmt=='percent'):
-                labels[i,j] = '${:.2f}({})\%$'.format(100*data[i,j], int(data_err[i,j]*10**4))
-            else:
-                labels[i,j] = '${:d}({})$'.format(int(data[i,j]), int(data_err[i,j]))
-    for y in range(data.shape[0]):
-        for x in range(data.shape[1]):
-            ax.text(x + 0.5, y + 0.5, labels[y, x].decode('ascii'),
-                    horizontalalignment='center',
-                    verticalalignment='center',
-                    fontsize='smaller')
-    plt.title(label)
-    plt.savefig(label.replace(' ','_')+'.png')
-    plt.savefig(label.replace(' ','_')+'.pdf')
-    plt.show()
-
-plot_hist2d(efficiencies, efficiencies_err, 'Efficiency', cmap='Greens', 
-            v=[0.99*np.min(efficiencies), 1.02*np.max(efficiencies)])
-plot_hist2d(purities, purities_err, 'Purity', cmap='Purples', 
-            v=[0.8*np.min(purities), 1.4*np.max(purities)])
-plot_hist2d(n_edges, n_edges_err, 'Edges', fmt='counts', cmap='Blues', 
-            v=[0.8*np.min(n_edges), 1.4*np.max(n_edges)])
-plot_hist2d(boundary_fractions, boundary_fractions_err, 'Boundary fraction', 
-            cmap='Oranges', v=[0.8*np.min(boundary_fractions), 
-                               1.4*np.max(boundary_fractions)])
+    # build the labels for the whole grid with numpy string ops
+    if (fmt=='percent'):
+        values = np.char.mod('$%.2f(', 100*data)
+        errors = np.char.mod('%d', (data_err*10**4).astype(np.int64))
+        label_end = r')\%$'
+    else:
+        values = np.char.mod('$%d(', data.astype(np.int64))
+        errors = np.char.mod('%d', data_err.astype(np.int64))
+        label_end = ')$'
+    labels = np.char.add(np.char.add(values, errors), label_end)
+    # place each label at the cell center, all labels share 
+    # the same text properties
+    text_kw = {'horizontalalignment': 'center',
+               'verticalalignment': 'center',
+               'fontsize': 'smaller'}
+    for (y, x), s in np.ndenumerate(labels):
+        ax.text(x + 0.5, y + 0.5, s, **text_kw)
+    ax.set_title(label)
+    stem = label.replace(' ','_')
+    fig.savefig(stem+'.png')
+    fig.savefig(stem+'.pdf')
+    plt.close(fig)
+
+def color_range(data, lo, hi):
+    """ scale the data min/max into the colormap [vmin, vmax]
+    """
+    data_min, data_max = data.min(), data.max()
+    return [lo*data_min, hi*data_max]
+
+# the heatmaps are independent, so render and save them in 
+# parallel, each worker drawing on its own figure; arguments are
+# (data, data_err, label, fmt, cmap, v)
+heatmaps = [(efficiencies, efficiencies_err, 'Efficiency', 'percent', 
+             'Greens', color_range(efficiencies, 0.99, 1.02)),
+            (purities, purities_err, 'Purity', 'percent', 
+             'Purples', color_range(purities, 0.8, 1.4)),
+            (n_edges, n_edges_err, 'Edges', 'counts', 
+             'Blues', color_range(n_edges, 0.8, 1.4)),
+            (boundary_fractions, boundary_fractions_err, 'Boundary fraction', 'percent', 
+             'Oranges', color_range(boundary_fractions, 0.8, 1.4))]
+with mp.Pool(processes=len(heatmaps)) as plot_pool:
+    plot_pool.starmap(plot_hist2d, heatmaps)
 
 
 print(n_edges, n_edges_err)